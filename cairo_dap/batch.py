@@ -0,0 +1,144 @@
+"""
+Headless scripted debugging, e.g. to check programs in CI.
+
+A script is a json object with the breakpoints to set and the actions to run:
+
+    {
+        "name": "check sum",
+        "functionBreakpoints": ["main"],
+        "breakpoints": {"examples/simple.cairo": [4]},
+        "actions": [
+            {"action": "continue"},
+            {"action": "evaluate", "expression": "x", "expect": "3000"},
+            {"action": "stackTrace"}
+        ]
+    }
+"""
+import logging
+from pathlib import Path
+
+from cairo_dap.hint_profiler import HintProfile
+from cairo_dap.memory import DEFAULT_MAX_LOG_SIZE
+from cairo_dap.runner import Runner
+from cairo_dap.trace import TraceRecorder
+
+_logger = logging.getLogger(__name__)
+
+
+def run_scripts(
+        program, program_input, layout, scripts, hint_code_cache=None, max_steps=None,
+        max_write_log=DEFAULT_MAX_LOG_SIZE, max_reference_values=None, profile_hints=False,
+        trace_columns=None):
+    """
+    Run each script on a fresh run of the program, sharing the pc metadata.
+
+    If trace_columns is given, the trace of each script is recorded in its own
+    subdirectory, named after the index of the script.
+    """
+    results = []
+    pc_metadata = None
+    for i, script in enumerate(scripts):
+        trace_recorder = TraceRecorder(Path(trace_columns) / str(i)) if trace_columns else None
+        hint_profile = HintProfile() if profile_hints else None
+        runner = Runner(
+            program, program_input, layout, pc_metadata=pc_metadata, trace_recorder=trace_recorder,
+            hint_profile=hint_profile, hint_code_cache=hint_code_cache, max_steps=max_steps,
+            max_write_log=max_write_log, max_reference_values=max_reference_values)
+        pc_metadata = runner.pc_metadata
+        result = run_script(runner, script)
+        if trace_recorder is not None:
+            # The recorder is only closed by the runner when the program exits.
+            trace_recorder.close()
+            result['traceColumns'] = str(Path(trace_columns) / str(i))
+        if hint_profile is not None:
+            result['hintProfile'] = runner.hint_profile()
+        results.append(result)
+    return results
+
+
+def run_script(runner, script):
+    result = {
+        'name': script.get('name'),
+        'success': True,
+        'breakpoints': _set_breakpoints(runner, script),
+        'actions': [],
+    }
+
+    for action in script.get('actions', []):
+        try:
+            action_result = _run_action(runner, action)
+        except Exception as exc:
+            _logger.exception('Action failed: %s', action)
+            action_result = {
+                'action': action.get('action'),
+                'success': False,
+                'error': f'{type(exc).__name__}: {exc}',
+            }
+        result['actions'].append(action_result)
+        if not action_result['success']:
+            result['success'] = False
+            break
+
+    result['output'] = list(runner.program_output())
+    return result
+
+
+def _set_breakpoints(runner, script):
+    breakpoints = [
+        runner.add_function_breakpoint({'id': i, 'name': name})
+        for i, name in enumerate(script.get('functionBreakpoints', []))
+    ]
+
+    for path, lines in script.get('breakpoints', {}).items():
+        source = {'path': str(Path.cwd() / path)}
+        breakpoints.extend(
+            runner.add_source_breakpoints(source, [{'line': line} for line in lines]))
+
+    return breakpoints
+
+
+def _run_action(runner, action):
+    action_name = action['action']
+    result = {'action': action_name, 'success': True}
+
+    if action_name == 'evaluate':
+        value = runner.evaluate(action['expression'])
+        result['expression'] = action['expression']
+        result['value'] = value
+        if 'expect' in action:
+            result['expect'] = str(action['expect'])
+            result['success'] = value == result['expect']
+        return result
+
+    if action_name == 'stackTrace':
+        frames, _ = runner.stack_trace(None, None)
+        result['stackFrames'] = frames
+        return result
+
+    step = _STEP_ACTIONS.get(action_name)
+    if step is None:
+        raise ValueError(f'Unknown action {action_name}')
+
+    step(runner)
+    if runner.stopped_on_step_budget():
+        # A program that doesn't reach the next stop within the budget is a failure.
+        result['success'] = False
+        result['error'] = 'the maximum number of steps was executed'
+    exception_info = runner.exception_info()
+    if exception_info is not None:
+        result['success'] = False
+        result['exception'] = exception_info
+        result['stackFrames'], _ = runner.stack_trace(None, None)
+    result['exited'] = runner.has_exited()
+    if not result['exited']:
+        frames, _ = runner.stack_trace(0, 1)
+        result['frame'] = frames[0]
+    return result
+
+
+_STEP_ACTIONS = {
+    'continue': Runner.continue_until_breakpoint,
+    'next': Runner.step_over,
+    'stepIn': Runner.step_in,
+    'stepOut': Runner.step_out,
+}
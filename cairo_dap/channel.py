@@ -8,6 +8,14 @@ class OutputChannel:
         self.seq = 1
         self._seq_lock = asyncio.Lock()
         self.writer = writer
+        # Requests that were responded to, until the server is done with them.
+        self._responded_requests = set()
+
+    def has_responded(self, request: Request):
+        return request.seq in self._responded_requests
+
+    def forget_request(self, request: Request):
+        self._responded_requests.discard(request.seq)
 
     async def send_event(self, event_name, body):
         seq = await self._get_and_inc_seq()
@@ -17,6 +25,7 @@ class OutputChannel:
     async def send_response(self, request: Request, body):
         seq = await self._get_and_inc_seq()
         response = Response(seq, request.seq, True, request.command, None, body)
+        self._responded_requests.add(request.seq)
         await write_message(self.writer, response)
 
     async def send_error_response(self, request: Request, message, format, variables):
@@ -29,6 +38,7 @@ class OutputChannel:
             }
         }
         response = Response(seq, request.seq, False, request.command, message, body)
+        self._responded_requests.add(request.seq)
         await write_message(self.writer, response)
 
     async def _get_and_inc_seq(self):
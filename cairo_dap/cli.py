@@ -11,8 +11,12 @@ import tempfile
 from starkware.cairo.lang.compiler.program import Program
 from starkware.cairo.lang.instances import LAYOUTS
 
+from cairo_dap.batch import run_scripts
+from cairo_dap.hint_profiler import HintCodeCache, HintProfile
+from cairo_dap.memory import DEFAULT_MAX_LOG_SIZE
 from cairo_dap.runner import Runner
 from cairo_dap.server import serve
+from cairo_dap.trace import TraceRecorder
 
 
 def main():
@@ -32,16 +36,63 @@ def main():
     args.add_argument(
         '--debug_info_file', type=argparse.FileType('w'),
         help='Output file name for debug information created at run time.')
+    args.add_argument(
+        '--trace_columns',
+        help='Directory where the pc, ap and fp columns of the execution trace are recorded.')
+    args.add_argument(
+        '--profile_hints', action='store_true',
+        help='Record the number of calls and the execution time of each hint.')
+    args.add_argument(
+        '--cache_hints', action='store_true',
+        help='Reuse the compiled hints when the program is restarted.')
+    args.add_argument(
+        '--max_cached_hints', type=int,
+        help='Maximum number of compiled hints kept with --cache_hints.')
+    args.add_argument(
+        '--max_steps', type=int,
+        help='Pause the program when it runs this number of steps without stopping.')
+    args.add_argument(
+        '--max_write_log', type=int, default=DEFAULT_MAX_LOG_SIZE,
+        help='Maximum number of memory writes tracked between two stops to reuse variable values '
+             f'(default: {DEFAULT_MAX_LOG_SIZE}).')
+    args.add_argument(
+        '--max_reference_values', type=int,
+        help='Maximum number of variable values kept from the previous stop.')
     args.add_argument(
         '--layout', choices=LAYOUTS.keys(), default='plain',
         help='The layout of the Cairo AIR.')
+    args.add_argument(
+        '--script', type=argparse.FileType('r'), action='append',
+        help='Run the json debugging script without starting the server. Can be repeated.')
     args = args.parse_args(sys.argv[1:])
 
     logging.basicConfig()
+    if args.script:
+        sys.exit(cairo_dap_batch(args))
+
     logging.getLogger().setLevel(logging.DEBUG)
     asyncio.run(cairo_dap(args))
 
 
+def cairo_dap_batch(args):
+    """Run the debugging scripts and print the results as json."""
+    program = _load_program(args.program)
+    program_input = json.load(args.program_input) if args.program_input else {}
+    scripts = [json.load(script) for script in args.script]
+
+    hint_code_cache = HintCodeCache(args.max_cached_hints) if args.cache_hints else None
+
+    results = run_scripts(
+        program, program_input, args.layout, scripts, hint_code_cache=hint_code_cache,
+        max_steps=args.max_steps, max_write_log=args.max_write_log,
+        max_reference_values=args.max_reference_values, profile_hints=args.profile_hints,
+        trace_columns=args.trace_columns)
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+    return 0 if all(result['success'] for result in results) else 1
+
+
 async def cairo_dap(args):
     """Start the DAP server."""
     trace_file = args.trace_file
@@ -59,7 +110,15 @@ async def cairo_dap(args):
     program = _load_program(args.program)
     program_input = json.load(args.program_input) if args.program_input else {}
 
-    runner = Runner(program, program_input, args.layout)
+    trace_recorder = TraceRecorder(args.trace_columns) if args.trace_columns else None
+
+    hint_profile = HintProfile() if args.profile_hints else None
+    hint_code_cache = HintCodeCache(args.max_cached_hints) if args.cache_hints else None
+
+    runner = Runner(
+        program, program_input, args.layout, trace_recorder=trace_recorder,
+        hint_profile=hint_profile, hint_code_cache=hint_code_cache, max_steps=args.max_steps,
+        max_write_log=args.max_write_log, max_reference_values=args.max_reference_values)
 
     await serve(runner, port=9999)
 
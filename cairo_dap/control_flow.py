@@ -0,0 +1,75 @@
+"""
+Static control flow of a program, used to find the instructions that can still
+run from the current state of the vm.
+"""
+from starkware.cairo.lang.compiler.encode import decode_instruction
+from starkware.cairo.lang.compiler.expression_simplifier import to_field_element
+from starkware.cairo.lang.compiler.instruction import Instruction
+
+
+def reachable_pc_offsets(program, pc_offset, return_pc_offsets):
+    """
+    Return the pc offsets that can be executed after the instruction at `pc_offset`,
+    in the current frame, in the functions it calls and in the callers that
+    resume at `return_pc_offsets`.
+
+    Return None if the program jumps to computed addresses, in which case any
+    instruction may be reachable.
+    """
+    successors = _successors(program, pc_offset)
+    if successors is None:
+        return None
+    pending = list(successors) + list(return_pc_offsets)
+    reachable = set()
+    while pending:
+        offset = pending.pop()
+        if offset in reachable:
+            continue
+        reachable.add(offset)
+        successors = _successors(program, offset)
+        if successors is None:
+            return None
+        pending.extend(successors)
+    return reachable
+
+
+def instruction_size(program, pc_offset):
+    return _decode(program, pc_offset).size
+
+
+def _successors(program, pc_offset):
+    # The offsets executed right after the instruction, including the called
+    # function, or None if the next pc is computed. A ret has no successors,
+    # since the callers' return pcs are followed separately.
+    if not 0 <= pc_offset < len(program.data):
+        return []
+    try:
+        instruction = _decode(program, pc_offset)
+    except Exception:
+        # Not an instruction, the vm would fail there.
+        return []
+    next_offset = pc_offset + instruction.size
+    if instruction.opcode is Instruction.Opcode.RET:
+        return []
+
+    pc_update = instruction.pc_update
+    if pc_update is Instruction.PcUpdate.REGULAR:
+        return [next_offset]
+    if instruction.op1_addr is not Instruction.Op1Addr.IMM or pc_update is Instruction.PcUpdate.JUMP \
+            or (pc_update is Instruction.PcUpdate.JUMP_REL and instruction.res is not Instruction.Res.OP1):
+        # Jumps to a computed address, or to an absolute address.
+        return None
+    target = pc_offset + to_field_element(val=instruction.imm, prime=program.prime)
+    if pc_update is Instruction.PcUpdate.JUMP_REL:
+        if instruction.opcode is Instruction.Opcode.CALL:
+            # The called function returns to the next instruction.
+            return [target, next_offset]
+        return [target]
+    # jmp rel if != 0.
+    return [target, next_offset]
+
+
+def _decode(program, pc_offset):
+    data = program.data
+    imm = data[pc_offset + 1] if pc_offset + 1 < len(data) else None
+    return decode_instruction(data[pc_offset], imm)
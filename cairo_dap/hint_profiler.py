@@ -0,0 +1,114 @@
+"""
+Timing of the python hints executed by the vm.
+"""
+import collections
+import time
+
+from starkware.cairo.lang.vm.vm import VirtualMachine
+
+
+class HintProfile:
+    """
+    Number of calls and cumulative time of each hint, keyed by pc.
+    """
+
+    def __init__(self):
+        self._stats = dict()
+
+    def reset(self):
+        self._stats = dict()
+
+    def record(self, pc, elapsed):
+        stats = self._stats.get(pc)
+        if stats is None:
+            stats = self._stats[pc] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+
+    def report(self, cwd, vm, program_base):
+        """Return the profile of each hint, the most expensive first."""
+        report = []
+        for pc, (calls, total_time) in self._stats.items():
+            report.append({
+                'pc': pc - program_base,
+                'location': _hint_location(cwd, vm, pc),
+                'calls': calls,
+                'totalTime': total_time,
+            })
+        report.sort(key=lambda entry: entry['totalTime'], reverse=True)
+        return report
+
+
+class HintCodeCache:
+    """
+    Compiled hints, keyed by source and filename, reused when the program is restarted.
+    If max_size is given, the least recently used hints are evicted.
+    """
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._codes = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._codes)
+
+    def get(self, key):
+        code = self._codes.get(key)
+        if code is not None:
+            self._codes.move_to_end(key)
+        return code
+
+    def put(self, key, code):
+        self._codes[key] = code
+        if self._max_size is not None and len(self._codes) > self._max_size:
+            self._codes.popitem(last=False)
+
+
+class HintProfilingVirtualMachine(VirtualMachine):
+    """
+    VirtualMachine that records the execution time of hints in `hint_profile`
+    (if given) and reuses compiled hints from `hint_code_cache` (if given).
+    """
+
+    def __init__(self, *args, hint_profile=None, hint_code_cache=None, **kwargs):
+        # Must be set before super().__init__(), which compiles the hints.
+        self.hint_profile = hint_profile
+        self.hint_code_cache = hint_code_cache
+        super().__init__(*args, **kwargs)
+
+    def compile_hint(self, source, filename, *args):
+        if self.hint_code_cache is None:
+            return super().compile_hint(source, filename, *args)
+        # The filename contains the hint id, which is the same for each run of the program.
+        key = (source, filename)
+        code = self.hint_code_cache.get(key)
+        if code is None:
+            code = super().compile_hint(source, filename, *args)
+            self.hint_code_cache.put(key, code)
+        return code
+
+    def exec_hint(self, code, globals_, *args):
+        if self.hint_profile is None:
+            return super().exec_hint(code, globals_, *args)
+        pc = self.run_context.pc
+        start = time.perf_counter()
+        try:
+            return super().exec_hint(code, globals_, *args)
+        finally:
+            self.hint_profile.record(pc, time.perf_counter() - start)
+
+
+def format_report(report):
+    lines = ['Hint profile (calls, total time, location):']
+    for entry in report:
+        lines.append(
+            f'{entry["calls"]:>10} {entry["totalTime"] * 1000:>12.3f}ms  {entry["location"]}')
+    return '\n'.join(lines)
+
+
+def _hint_location(cwd, vm, pc):
+    location = vm.get_location(pc=pc)
+    if location is None:
+        return f'pc={pc}'
+    source_location = location.hint.location if location.hint is not None else location.inst
+    return f'{cwd / source_location.input_file.filename}:{source_location.start_line}'
@@ -0,0 +1,79 @@
+from starkware.cairo.lang.vm.memory_dict import MemoryDict
+
+# Default maximum number of addresses in the write log. Past it, the log is
+# dropped until it's taken, instead of copying the addresses of a long run.
+DEFAULT_MAX_LOG_SIZE = 100000
+
+
+class WriteLogMemoryDict(MemoryDict):
+    """
+    MemoryDict that keeps track of the addresses written since the log was last taken.
+
+    Cairo memory is write-once, so the log only contains addresses that were unknown
+    the last time the log was taken.
+
+    If more than max_log_size addresses are written, the log is dropped and
+    take_write_log returns None.
+
+    It also keeps the used size (highest written offset + 1) of the segments
+    passed to track_segment_sizes.
+    """
+
+    def __init__(self, *args, max_log_size=DEFAULT_MAX_LOG_SIZE, **kwargs):
+        # Must be defined before super().__init__(), which may write initial values.
+        self._write_log = set()
+        self._max_log_size = max_log_size
+        self._segment_sizes = dict()
+        super().__init__(*args, **kwargs)
+
+    def __setitem__(self, addr, value):
+        is_new = addr not in self.data
+        super().__setitem__(addr, value)
+        if not is_new:
+            return
+        if self._write_log is not None:
+            self._write_log.add(addr)
+            if self._max_log_size is not None and len(self._write_log) > self._max_log_size:
+                self._write_log = None
+        segment_index = getattr(addr, 'segment_index', None)
+        size = self._segment_sizes.get(segment_index)
+        if size is not None and addr.offset >= size:
+            self._segment_sizes[segment_index] = addr.offset + 1
+
+    def track_segment_sizes(self, segment_indices):
+        for segment_index in segment_indices:
+            self._segment_sizes.setdefault(segment_index, 0)
+
+    def segment_used_size(self, segment_index):
+        return self._segment_sizes[segment_index]
+
+    def write_log_size(self):
+        return len(self._write_log) if self._write_log is not None else 0
+
+    def take_write_log(self):
+        write_log = self._write_log
+        self._write_log = set()
+        return write_log
+
+
+class ReadRecordingMemory:
+    """
+    Read-only view over the vm memory that records the addresses being read,
+    including the ones that are not known yet.
+    """
+
+    def __init__(self, memory):
+        self._memory = memory
+        self.addresses = set()
+
+    def __getitem__(self, addr):
+        self.addresses.add(addr)
+        return self._memory[addr]
+
+    def __contains__(self, addr):
+        self.addresses.add(addr)
+        return addr in self._memory
+
+    def get(self, addr, default=None):
+        self.addresses.add(addr)
+        return self._memory.get(addr, default)
@@ -1,38 +1,108 @@
+import collections
+import dataclasses
+import functools
 import logging
+import resource
+import sys
 from pathlib import Path
 
 from starkware.cairo.lang.compiler.identifier_definition import ReferenceDefinition
 from starkware.cairo.lang.compiler.identifier_manager import MissingIdentifierError
 from starkware.cairo.lang.compiler.expression_simplifier import to_field_element
 from starkware.cairo.lang.vm.cairo_runner import CairoRunner
-from starkware.cairo.lang.vm.memory_dict import MemoryDict
+from starkware.cairo.lang.vm.memory_dict import InconsistentMemoryError
+from starkware.cairo.lang.vm.vm import HintException, InconsistentAutoDeductionError, VmException
 
+from cairo_dap.control_flow import instruction_size, reachable_pc_offsets
+from cairo_dap.hint_profiler import HintProfilingVirtualMachine
+from cairo_dap.memory import DEFAULT_MAX_LOG_SIZE, ReadRecordingMemory, WriteLogMemoryDict
 from cairo_dap.watch_evaluator import WatchEvaluator
 
 _logger = logging.getLogger(__name__)
 
+EXCEPTION_FILTERS = [
+    {'filter': 'assert', 'label': 'Assertion failures', 'default': True},
+    {'filter': 'hint', 'label': 'Hint errors', 'default': True},
+    {'filter': 'vm', 'label': 'Other VM errors', 'default': True},
+]
+
 
 class Runner:
-    def __init__(self, program, program_input, layout):
-        initial_memory = MemoryDict()
+    def __init__(
+            self, program, program_input, layout, pc_metadata=None, trace_recorder=None,
+            hint_profile=None, hint_code_cache=None, max_steps=None, max_write_log=DEFAULT_MAX_LOG_SIZE,
+            max_reference_values=None):
+        self._program = program
+        self._program_input = program_input
+        self._layout = layout
+        self._trace_recorder = trace_recorder
+        self._hint_profile = hint_profile
+        self._hint_code_cache = hint_code_cache
+        # Maximum number of steps executed each time the program is resumed.
+        self._max_steps = max_steps
+        self._max_write_log = max_write_log
+        self._max_reference_values = max_reference_values
+
+        self._initialize_runner()
+
+        self._function_breakpoints = []
+        self._source_breakpoints = dict()
+        self._breakpoint_pcs = set()
+        self._target_pcs = set()
+        self._exception_filters = set(f['filter'] for f in EXCEPTION_FILTERS if f['default'])
+        self._stopped_at_target = False
+        self._output_offset = 0
+
+        self._cwd = Path.cwd()
+        if pc_metadata is None:
+            pc_metadata = PcMetadata(self._cwd, self._runner)
+        self._pc_metadata = pc_metadata
 
-        runner = CairoRunner(program=program, layout=layout, memory=initial_memory, proof_mode=False)
+    def _initialize_runner(self):
+        initial_memory = WriteLogMemoryDict(max_log_size=self._max_write_log)
+
+        runner = CairoRunner(
+            program=self._program, layout=self._layout, memory=initial_memory, proof_mode=False)
 
         runner.initialize_segments()
+        # The builtin segments are empty until the program runs.
+        initial_memory.track_segment_sizes(
+            builtin_runner.base.segment_index for builtin_runner in runner.builtin_runners.values())
         runner.initialize_main_entrypoint()
-        runner.initialize_vm(hint_locals={'program_input': program_input})
+
+        # The profile only covers the current run of the program.
+        if self._hint_profile is not None:
+            self._hint_profile.reset()
+        hint_locals = {'program_input': self._program_input}
+        if self._hint_profile is None and self._hint_code_cache is None:
+            runner.initialize_vm(hint_locals=hint_locals)
+        else:
+            vm_class = functools.partial(
+                HintProfilingVirtualMachine,
+                hint_profile=self._hint_profile,
+                hint_code_cache=self._hint_code_cache)
+            runner.initialize_vm(hint_locals=hint_locals, vm_class=vm_class)
 
         self._runner = runner
+        self._memory = initial_memory
 
         self._runner.vm.get_traceback()
 
-        self._function_breakpoints = []
-        self._source_breakpoints = dict()
         self._frame_data = FrameData()
+        self._reference_values = ReferenceValues(max_size=self._max_reference_values)
 
         self._has_relocated = False
-
-        self._cwd = Path.cwd()
+        self._exception = None
+        # Description and message of the error, computed once when it's raised.
+        self._exception_text = None
+        # Step of the last stop, the step budget applies to the steps executed since.
+        self._resume_step = 0
+        self._stopped_on_step_budget = False
+
+    @property
+    def pc_metadata(self):
+        # Can be shared with other runners of the same program.
+        return self._pc_metadata
 
     def add_function_breakpoint(self, breakpoint):
         func_name = breakpoint['name']
@@ -51,44 +121,70 @@ class Runner:
         new_breakpoint['id'] = breakpoint['id']
 
         self._function_breakpoints.append(new_breakpoint)
+        self._update_breakpoint_pcs()
 
         return _breakpoint_json_data(new_breakpoint)
 
     def add_source_breakpoints(self, source, breakpoints):
         new_breakpoints = []
         path = source['path']
-
-        locations_in_file = []
-        for instruction, location in self._runner.vm.instruction_debug_info.items():
-            location_path = str(self._cwd / location.inst.input_file.filename)
-            if location_path == path:
-                locations_in_file.append((location, instruction))
+        line_index = self._pc_metadata.line_index()
 
         for breakpoint in breakpoints:
-            line = breakpoint['line']
-            prev_line = None
-            for location, pc in locations_in_file:
-                start_line = location.inst.start_line
-                end_line = location.inst.end_line
-
-                if start_line <= line <= end_line:
-                    _logger.debug('Adding source breakpoint at %s', pc)
-                    new_breakpoint = self._create_breakpoint_at_pc(pc)
-                    new_breakpoints.append(new_breakpoint)
-                elif prev_line is None:
-                    pass
-                elif prev_line < line <= end_line:
-                    # If the user clicked on a comment or empty line,
-                    # add breakpoint to the next instruction.
-                    _logger.debug('Adding source breakpoint (empty line) at %s', pc)
-                    new_breakpoint = self._create_breakpoint_at_pc(pc)
-                    new_breakpoints.append(new_breakpoint)
-
-                prev_line = end_line
+            for pc in line_index.pcs_at_line(path, breakpoint['line']):
+                _logger.debug('Adding source breakpoint at %s', pc)
+                new_breakpoint = self._create_breakpoint_at_pc(pc)
+                new_breakpoints.append(new_breakpoint)
 
         self._source_breakpoints[path] = new_breakpoints
+        self._update_breakpoint_pcs()
         return [_breakpoint_json_data(bp) for bp in new_breakpoints]
 
+    def set_exception_filters(self, filters):
+        self._exception_filters = set(filters)
+
+    def exception_info(self):
+        # Return the error that stopped the vm, or None.
+        exc = self._exception
+        if exc is None:
+            return None
+        description, message = self._exception_text
+        return {
+            'exceptionId': _exception_filter(exc),
+            'description': description,
+            'breakMode': 'always' if self.breaks_on_exception() else 'never',
+            'details': {
+                'message': message,
+                'typeName': type(getattr(exc, 'inner_exc', exc)).__name__,
+                'stackTrace': getattr(exc, 'traceback', None) or '',
+            },
+        }
+
+    def breaks_on_exception(self):
+        # False if the session should end on the current error instead of stopping.
+        return self._exception is not None and _exception_filter(self._exception) in self._exception_filters
+
+    def location_pcs(self, source, line):
+        return self._pc_metadata.line_index().pcs_at_line(source['path'], line)
+
+    def reachable_pcs(self, pcs):
+        # Return the pcs that the program can still execute going forward, i.e.
+        # in the current frame, in the functions it calls or in its callers.
+        if self.has_exited() or self._exception is not None:
+            return []
+        runner = self._runner
+        program = runner.program
+        program_base = runner.program_base
+        run_context = runner.vm.run_context
+        return_pc_offsets = [
+            call_pc - program_base + instruction_size(program, call_pc - program_base)
+            for call_pc in run_context.get_traceback_entries()
+        ]
+        reachable = reachable_pc_offsets(program, run_context.pc - program_base, return_pc_offsets)
+        if reachable is None:
+            return list(pcs)
+        return [pc for pc in pcs if pc - program_base in reachable]
+
     def stack_trace(self, start_frame, levels):
         frames = self._frame_data.frames
 
@@ -107,8 +203,17 @@ class Runner:
     def scopes(self, frame_id):
         return self._frame_data.scopes_by_frame[frame_id]
 
-    def variables(self, variables_ref):
-        return self._frame_data.variables_by_reference[variables_ref]
+    def variables(self, variables_ref, filter=None, start=None, count=None):
+        return self._frame_data.variables(variables_ref, filter, start, count)
+
+    def has_variables(self, variables_ref):
+        # False if the variables still need to be computed.
+        return self._frame_data.has_variables(variables_ref)
+
+    def evaluate(self, expression):
+        runner = self._runner
+        watch_evaluator = WatchEvaluator(runner, runner.program, runner.vm.run_context, runner.program_base)
+        return watch_evaluator.eval_suppress_errors(expression)
 
     def step_in(self):
         # Just execute one step, going inside a function if necessary.
@@ -147,35 +252,121 @@ class Runner:
                     break
             self._compute_frame_data()
 
+    def goto_step(self, step, max_steps=None):
+        # The vm can't go back, so restart the program to reach a previous step.
+        # The program output already sent is not sent again.
+        # Like continue_until_breakpoint, returns False if max_steps were executed
+        # before reaching the step, and the caller resumes with the same step.
+        if step < self._runner.vm.current_step:
+            self._initialize_runner()
+        steps = 0
+        while self._runner.vm.current_step < step and not self.has_exited():
+            if max_steps is not None and steps >= max_steps:
+                return False
+            self._vm_step()
+            if self._stopped_on_step_budget or self._exception is not None:
+                break
+            steps += 1
+        self._compute_frame_data()
+        return True
+
+    def trace(self):
+        # Return the trace recorded so far, or None if the trace is not recorded.
+        if self._trace_recorder is None:
+            return None
+        return self._trace_recorder.trace()
+
+    def hint_profile(self):
+        # Return the hints profile, or None if hints are not profiled.
+        if self._hint_profile is None:
+            return None
+        runner = self._runner
+        return self._hint_profile.report(self._cwd, runner.vm, runner.program_base)
+
+    def function_pc_offset(self, func_name):
+        # Return the pc offset of the function, or None if there's no such function.
+        try:
+            return self._runner.program.get_label(func_name)
+        except MissingIdentifierError:
+            return None
+
+    def pause(self):
+        # Stop where the vm currently is, e.g. after continue_until_breakpoint
+        # ran out of steps.
+        self._compute_frame_data()
+
+    def stopped_on_step_budget(self):
+        # True if the program stopped because it ran max_steps since the previous stop.
+        return self._stopped_on_step_budget
+
+    def memory_usage(self):
+        runner = self._runner
+        return {
+            'vmMemoryCells': len(runner.vm_memory),
+            'vmTraceEntries': len(runner.vm.trace),
+            'cachedPcs': len(self._pc_metadata),
+            'writeLogSize': self._memory.write_log_size(),
+            'referenceValues': len(self._reference_values),
+            'cachedHints': len(self._hint_code_cache) if self._hint_code_cache is not None else None,
+            # Resident set size of the adapter process, in bytes.
+            'rss': _current_rss(),
+            'peakRss': _peak_rss(),
+        }
+
     def has_exited(self):
         return self._runner.vm.run_context.pc == self._runner.final_pc
 
-    def continue_until_breakpoint(self):
-        while True:
-            breakpoint_hit = self._vm_step()
-            if breakpoint_hit or self.has_exited():
-                break
+    def continue_until_breakpoint(self, max_steps=None, target_pcs=None):
+        # Returns False if max_steps were executed without hitting a breakpoint
+        # or the end of the program, so that the caller can do some work
+        # (e.g. stream output) and resume.
+        # target_pcs are treated as breakpoints for this call only.
+        self._target_pcs = set(target_pcs) if target_pcs is not None else set()
+        self._stopped_at_target = False
+        try:
+            steps = 0
+            while True:
+                breakpoint_hit = self._vm_step()
+                if breakpoint_hit or self.has_exited():
+                    break
+                steps += 1
+                if max_steps is not None and steps >= max_steps:
+                    return False
+        finally:
+            self._target_pcs = set()
 
+        self._stopped_at_target = target_pcs is not None and self._runner.vm.run_context.pc in target_pcs
         self._compute_frame_data()
+        return True
 
-    def program_output(self):
-        if not self._has_relocated:
-            yield from []
-            return
+    def stopped_at_target(self):
+        # True if the last continue stopped at one of its target pcs.
+        return self._stopped_at_target
 
+    def program_output(self):
+        # Yield the output builtin cells written since the last call.
+        # Cells are read directly from the (unrelocated) vm memory, so this
+        # works while the program is still running. Output stops at the first
+        # cell that was not written yet, unless the program has exited.
         runner = self._runner
         if 'output_builtin' not in runner.builtin_runners:
-            yield from []
             return
 
         output_runner = runner.builtin_runners['output_builtin']
-        _, size = output_runner.get_used_cells_and_allocated_size(runner)
-        for i in range(size):
-            val = runner.vm_memory.get(output_runner.base + i)
+        if self._has_relocated:
+            _, size = output_runner.get_used_cells_and_allocated_size(runner)
+        else:
+            size = None
+
+        while size is None or self._output_offset < size:
+            val = runner.vm_memory.get(output_runner.base + self._output_offset)
             if val is not None:
                 yield f'{to_field_element(val=val, prime=runner.program.prime)}'
-            else:
+            elif size is not None:
                 yield '<missing>'
+            else:
+                return
+            self._output_offset += 1
 
     def _vm_step(self):
         runner = self._runner
@@ -184,21 +375,48 @@ class Runner:
         if runner.vm.run_context.pc == runner.final_pc:
             return False
 
-        runner.vm_step()
+        # Stop like on a breakpoint, without executing the step.
+        if self._max_steps is not None and runner.vm.current_step - self._resume_step >= self._max_steps:
+            self._stopped_on_step_budget = True
+            return True
+
+        # The vm can't go past an error: every new step would fail the same way.
+        if self._exception is not None:
+            return True
 
+        try:
+            runner.vm_step()
+        except Exception as exc:
+            pc = runner.vm.run_context.pc
+            # The vm reads the source files to add the traceback to an error, and
+            # raises an OSError instead if they're not there: keep the original error.
+            if isinstance(exc, OSError) and exc.__context__ is not None:
+                exc = VmException(pc, runner.vm.get_location(pc), exc.__context__)
+            self._exception = exc
+            self._exception_text = _exception_text(exc)
+            _logger.info('VM error at pc %s: %s', pc, self._exception_text[0])
+            return True
+        self._stopped_on_step_budget = False
+
+        trace_recorder = self._trace_recorder
+        # Steps replayed after a restart are already recorded.
+        if trace_recorder is not None and runner.vm.current_step > len(trace_recorder):
+            entry = runner.vm.trace[-1]
+            trace_recorder.append(entry.pc - runner.program_base, entry.ap.offset, entry.fp.offset)
+
+        pc = runner.vm.run_context.pc
+        return pc in self._breakpoint_pcs or pc in self._target_pcs
+
+    def _update_breakpoint_pcs(self):
         source_breakpoints = [
             bp for breakpoints in self._source_breakpoints.values()
             for bp in breakpoints
         ]
-
-        for breakpoint in self._function_breakpoints + source_breakpoints:
-            if runner.vm.run_context.pc == breakpoint['pc']:
-                return True
-
-        return False
+        self._breakpoint_pcs = set(
+            breakpoint['pc'] for breakpoint in self._function_breakpoints + source_breakpoints)
 
     def _create_breakpoint_at_pc(self, pc):
-        frame = _frame_at_pc(self._cwd, self._runner, pc)
+        frame = self._pc_metadata.get(pc).frame()
         return {
             'verified': True,
             'pc': pc,
@@ -213,19 +431,40 @@ class Runner:
         #
         # The client will ask for this data in separate requests, but we compute
         # everything in this function.
+        self._resume_step = self._runner.vm.current_step
         if self.has_exited():
             self._relocate()
             return
 
         frame_data = FrameData()
-        cwd = self._cwd
+        pc_metadata = self._pc_metadata
+        reference_values = self._reference_values
         runner = self._runner
 
-        frame, scopes_with_variables = _frame_data_at_pc(cwd, runner, runner.vm.run_context.pc)
-        frame_data.add_frame_data(frame, scopes_with_variables)
-
-        for traceback_pc in reversed(runner.vm.run_context.get_traceback_entries()):
-            frame, scopes_with_variables = _frame_data_at_pc(cwd, runner, traceback_pc)
+        reference_values.begin_stop(self._memory.take_write_log())
+
+        run_context = runner.vm.run_context
+        traceback_pcs = list(reversed(run_context.get_traceback_entries()))
+        depth = len(traceback_pcs)
+
+        frame, scopes_with_variables = _frame_data_at_pc(
+            pc_metadata, reference_values, runner, run_context, depth)
+        frame_id = frame_data.add_frame_data(frame, scopes_with_variables)
+        frame_data.add_lazy_scope(frame_id, 'Builtins', self._builtin_variables)
+
+        frame_context = run_context
+        for traceback_pc in traceback_pcs:
+            depth -= 1
+            # The references of a caller frame are evaluated with its own registers:
+            # the call saved its fp at [fp - 2], and its ap is right before the saved
+            # fp and return pc.
+            frame_context = dataclasses.replace(
+                frame_context,
+                pc=traceback_pc,
+                ap=frame_context.fp - 2,
+                fp=run_context.memory[frame_context.fp - 2])
+            frame, scopes_with_variables = _frame_data_at_pc(
+                pc_metadata, reference_values, runner, frame_context, depth)
             frame_data.add_frame_data(frame, scopes_with_variables)
 
         self._frame_data = frame_data
@@ -239,8 +478,38 @@ class Runner:
         runner.finalize_segments_by_effective_size()
         runner.relocate()
 
+        if self._trace_recorder is not None:
+            self._trace_recorder.close()
+
         self._has_relocated = True
 
+    def _builtin_variables(self, frame_data):
+        variables = []
+        for name, builtin_runner in self._runner.builtin_runners.items():
+            base = builtin_runner.base
+            size = self._memory.segment_used_size(base.segment_index)
+            variables.append({
+                'name': name,
+                'value': f'{base} ({size} cells)',
+                'variablesReference': frame_data.add_indexed_variables(
+                    size, functools.partial(self._builtin_cell_variables, base)),
+                'indexedVariables': size,
+            })
+        return variables
+
+    def _builtin_cell_variables(self, base, start, end):
+        # Only the cells of the requested page are read, from the unrelocated memory.
+        runner = self._runner
+        prime = runner.program.prime
+        return [
+            {
+                'name': f'[{i}]',
+                'value': _format_cell(runner.vm_memory.get(base + i), prime),
+                'variablesReference': 0,
+            }
+            for i in range(start, end)
+        ]
+
 
 class FrameData:
     def __init__(self):
@@ -260,6 +529,49 @@ class FrameData:
             scope['variablesReference'] = ref
             del scope['variables']
         self.scopes_by_frame[id] = scopes_with_variables
+        return id
+
+    def add_lazy_scope(self, frame_id, name, compute_variables):
+        # The variables of lazy scopes are only computed when the client asks for them.
+        ref = self._next_variable_reference()
+        self.variables_by_reference[ref] = compute_variables
+        self.scopes_by_frame[frame_id].append({
+            'name': name,
+            'variablesReference': ref,
+            'expensive': True,
+        })
+
+    def add_variables(self, variables):
+        ref = self._next_variable_reference()
+        self.variables_by_reference[ref] = variables
+        return ref
+
+    def add_indexed_variables(self, size, compute_variables):
+        # Indexed variables are computed for each page the client asks for,
+        # with compute_variables(start, end).
+        ref = self._next_variable_reference()
+        self.variables_by_reference[ref] = _IndexedVariables(size, compute_variables)
+        return ref
+
+    def has_variables(self, ref):
+        return not callable(self.variables_by_reference.get(ref))
+
+    def variables(self, ref, filter=None, start=None, count=None):
+        # filter, start and count are the paging arguments of the variables request.
+        variables = self.variables_by_reference[ref]
+        start = start or 0
+        if isinstance(variables, _IndexedVariables):
+            if filter == 'named':
+                return []
+            end = variables.size if not count else min(variables.size, start + count)
+            return variables.compute_variables(start, end)
+
+        if callable(variables):
+            variables = variables(self)
+            self.variables_by_reference[ref] = variables
+        if filter == 'indexed':
+            return []
+        return variables[start:start + count] if count else variables[start:]
 
     def _next_variable_reference(self):
         v = self._var_ref_id
@@ -267,9 +579,164 @@ class FrameData:
         return v
 
 
-def _frame_data_at_pc(cwd, runner, pc):
-    frame = _frame_at_pc(cwd, runner, pc)
-    variables = _variables_at_pc(runner, pc)
+class _IndexedVariables:
+    def __init__(self, size, compute_variables):
+        self.size = size
+        self.compute_variables = compute_variables
+
+
+class PcMetadata:
+    # Frame and scope data that only depends on the pc. It's computed lazily
+    # the first time a pc is seen and kept for the lifetime of the program.
+    # Doesn't keep a reference to the runner so that it can outlive it.
+    # Bounded by the number of instructions of the program.
+    def __init__(self, cwd, runner):
+        self._cwd = cwd
+        self._program = runner.program
+        self._program_base = runner.program_base
+        self._instruction_debug_info = runner.vm.instruction_debug_info
+        self._metadata_by_pc = dict()
+        self._line_index = None
+
+    def __len__(self):
+        return len(self._metadata_by_pc)
+
+    def get(self, pc):
+        metadata = self._metadata_by_pc.get(pc)
+        if metadata is None:
+            metadata = _StaticPcData(
+                self._cwd, self._program, self._program_base, self._instruction_debug_info[pc], pc)
+            self._metadata_by_pc[pc] = metadata
+        return metadata
+
+    def line_index(self):
+        if self._line_index is None:
+            self._line_index = LineIndex(self._cwd, self._instruction_debug_info)
+        return self._line_index
+
+
+class LineIndex:
+    # The lines of each instruction, grouped by source file.
+    def __init__(self, cwd, instruction_debug_info):
+        self._locations_by_path = collections.defaultdict(list)
+        for pc, location in instruction_debug_info.items():
+            path = str(cwd / location.inst.input_file.filename)
+            self._locations_by_path[path].append(
+                (location.inst.start_line, location.inst.end_line, pc))
+
+    def pcs_at_line(self, path, line):
+        pcs = []
+        prev_line = None
+        for start_line, end_line, pc in self._locations_by_path.get(path, []):
+            if start_line <= line <= end_line:
+                pcs.append(pc)
+            elif prev_line is None:
+                pass
+            elif prev_line < line <= end_line:
+                # If the user clicked on a comment or empty line,
+                # use the next instruction.
+                pcs.append(pc)
+
+            prev_line = end_line
+        return pcs
+
+
+class _StaticPcData:
+    def __init__(self, cwd, program, program_base, location, pc):
+        self.source = {
+            'path': str(cwd / location.inst.input_file.filename)
+        }
+        self.line = location.inst.start_line
+        self.end_line = location.inst.end_line
+        self.column = location.inst.start_col
+        self.end_column = location.inst.end_col
+
+        pc_offset = pc - program_base
+        instruction_location = program.debug_info.instruction_locations[pc_offset]
+        self.scope_name = instruction_location.accessible_scopes[-1]
+        self.ap_tracking = instruction_location.flow_tracking_data.ap_tracking
+        self._reference_ids = instruction_location.flow_tracking_data.reference_ids
+        self._identifiers = program.identifiers
+        self._references = None
+
+    @property
+    def references(self):
+        # The name and reference id of each reference of the scope.
+        # Not needed to set breakpoints, so only computed when the pc is reached.
+        if self._references is None:
+            scope_items = self._identifiers.get_scope(self.scope_name).identifiers
+            self._references = [
+                (name, self._reference_ids.get(identifier_definition.full_name))
+                for name, identifier_definition in scope_items.items()
+                if isinstance(identifier_definition, ReferenceDefinition)
+            ]
+        return self._references
+
+    def frame(self):
+        # Return a new dict every time since callers add the frame id to it.
+        return {
+            'source': self.source,
+            'line': self.line,
+            'endLine': self.end_line,
+            'column': self.column,
+            'endColumn': self.end_column,
+        }
+
+
+class ReferenceValues:
+    # Values of the references at the previous stop, together with the registers
+    # and memory cells they were computed from. Used to mark changed variables and
+    # to skip re-evaluating references whose inputs didn't change.
+    # The registers are the ones the reference actually depends on, so that the
+    # values of frames that didn't run since the previous stop are reused.
+    # If max_size is given, only the first max_size values of a stop are kept.
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._previous = dict()
+        self._current = dict()
+        self._written = set()
+
+    def __len__(self):
+        return len(self._previous) + len(self._current)
+
+    def begin_stop(self, written):
+        self._previous = self._current
+        self._current = dict()
+        self._written = written
+
+    def variable(self, key, registers, evaluate):
+        previous = self._previous.get(key)
+        # A written set of None means the log overflowed, and anything might have changed.
+        if previous is not None and previous.registers == registers \
+                and self._written is not None and previous.addresses.isdisjoint(self._written):
+            value = previous.value
+            addresses = previous.addresses
+        else:
+            value, addresses = evaluate()
+        if self._max_size is None or len(self._current) < self._max_size:
+            self._current[key] = _ReferenceValue(registers, value, addresses)
+
+        variable = {
+            'name': key[-1],
+            'value': value,
+            'variablesReference': 0,
+        }
+        if previous is not None and previous.value != value:
+            variable['presentationHint'] = {'attributes': ['changed']}
+        return variable
+
+
+class _ReferenceValue:
+    def __init__(self, registers, value, addresses):
+        self.registers = registers
+        self.value = value
+        self.addresses = addresses
+
+
+def _frame_data_at_pc(pc_metadata, reference_values, runner, run_context, depth):
+    metadata = pc_metadata.get(run_context.pc)
+    frame = metadata.frame()
+    variables = _variables_at_pc(reference_values, runner, run_context, depth, metadata)
     scopes = [{
         'name': 'Locals',
         'presentationHint': 'locals',
@@ -281,36 +748,71 @@ def _frame_data_at_pc(cwd, runner, pc):
     return frame, scopes
 
 
-def _frame_at_pc(cwd, runner, pc):
-    location = runner.vm.get_location(pc=pc)
-    return {
-        'source': {
-            'path': str(cwd / location.inst.input_file.filename)
-        },
-        'line': location.inst.start_line,
-        'endLine': location.inst.end_line,
-        'column': location.inst.start_col,
-        'endColumn': location.inst.end_col,
-    }
-
-
-def _variables_at_pc(runner, pc):
-    pc_offset = pc - runner.program_base
-    scope_name = runner.program.debug_info.instruction_locations[pc_offset].accessible_scopes[-1]
-    scope_items = runner.program.identifiers.get_scope(scope_name).identifiers
-
-    variables = []
-    watch_evaluator = WatchEvaluator(runner, runner.program, runner.vm.run_context, runner.program_base)
-
-    for name, identifier_definition in scope_items.items():
-        if isinstance(identifier_definition, ReferenceDefinition):
-            value = watch_evaluator.eval(name)
-            variables.append({
-                'name': name,
-                'value': value,
-                'variablesReference': 0,
-            })
-    return variables
+def _variables_at_pc(reference_values, runner, run_context, depth, metadata):
+    # A reference only depends on fp and on the value of ap at the start of the
+    # ap tracking group of the pc, besides the memory cells it reads.
+    ap_tracking = metadata.ap_tracking
+    frame_registers = (run_context.fp, ap_tracking.group, run_context.ap - ap_tracking.offset)
+
+    def evaluate(name):
+        memory = ReadRecordingMemory(run_context.memory)
+        watch_evaluator = WatchEvaluator(
+            runner, runner.program, run_context, runner.program_base, memory=memory)
+        # Don't lose the frame if a reference can't be evaluated, e.g. after a vm error.
+        return watch_evaluator.eval_suppress_errors(name), memory.addresses
+
+    return [
+        reference_values.variable(
+            (depth, metadata.scope_name, name),
+            (*frame_registers, reference_id),
+            lambda: evaluate(name))
+        for name, reference_id in metadata.references
+    ]
+
+
+def _exception_filter(exc):
+    inner_exc = getattr(exc, 'inner_exc', exc)
+    if isinstance(inner_exc, HintException):
+        return 'hint'
+    # The vm raises a plain Exception for failed assert_eq instructions.
+    if isinstance(inner_exc, (InconsistentMemoryError, InconsistentAutoDeductionError)) \
+            or 'ASSERT_EQ instruction failed' in str(inner_exc):
+        return 'assert'
+    return 'vm'
+
+
+def _exception_text(exc):
+    # Return the description and the full message of the error. The message of a
+    # LocationError includes the source code, which can fail to be read.
+    description = getattr(exc, 'message', None)
+    try:
+        message = str(exc)
+    except Exception:
+        message = description if description is not None else repr(exc)
+    return (description if description is not None else message), message
+
+
+def _current_rss():
+    # Only available on Linux, None elsewhere.
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _peak_rss():
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _format_cell(value, prime):
+    if value is None:
+        return '<missing>'
+    if isinstance(value, int):
+        return f'{to_field_element(val=value, prime=prime)}'
+    return str(value)
 
 
 def _breakpoint_json_data(bp):
@@ -1,8 +1,42 @@
 import asyncio
+import logging
 
 from cairo_dap.channel import OutputChannel
+from cairo_dap.hint_profiler import format_report
+from cairo_dap.runner import EXCEPTION_FILTERS
 from cairo_dap.messaging import Request, read_message
 
+_logger = logging.getLogger(__name__)
+
+# Number of vm steps executed by `continue` before flushing the program output.
+_CONTINUE_CHUNK_STEPS = 10000
+
+# Commands that change the execution state are handled one at a time, in the
+# order they are received. All other requests are handled concurrently.
+_ORDERED_COMMANDS = {
+    'initialize',
+    'attach',
+    'disconnect',
+    'configurationDone',
+    'setBreakpoints',
+    'setFunctionBreakpoints',
+    'setExceptionBreakpoints',
+    'continue',
+    'next',
+    'stepIn',
+    'stepOut',
+    'gotoStep',
+    'runToLocation',
+}
+
+# Commands that keep running after their response was sent, until the `stopped`
+# event. Cancelling them pauses the program.
+_RESUMING_COMMANDS = {
+    'continue',
+    'runToLocation',
+    'gotoStep',
+}
+
 
 class _MessageDispatcher:
     def __init__(self):
@@ -36,13 +70,82 @@ class Server:
         self.reader = reader
         self.output = OutputChannel(writer)
 
+        self._ordered_requests = asyncio.Queue()
+        self._running_requests = dict()
+        # Queued ordered requests, and the ones among them that were cancelled
+        # before they started.
+        self._queued_requests = set()
+        self._cancelled_requests = set()
+        self._pause_requested = False
+        self._progress_id = 0
+        self._supports_progress = False
+
     async def run_forever(self):
+        ordered_worker = asyncio.ensure_future(self._handle_ordered_requests())
+        try:
+            while True:
+                message = await read_message(self.reader)
+                if message.command in _ORDERED_COMMANDS:
+                    self._queued_requests.add(message.seq)
+                    await self._ordered_requests.put(message)
+                else:
+                    self._start_request(message)
+        finally:
+            ordered_worker.cancel()
+
+    async def _handle_ordered_requests(self):
         while True:
-            message = await read_message(self.reader)
-            await self.dispatcher.call(self, message)
+            request = await self._ordered_requests.get()
+            self._queued_requests.discard(request.seq)
+            if request.seq in self._cancelled_requests:
+                self._cancelled_requests.discard(request.seq)
+                await self._send_cancelled(request)
+                self.output.forget_request(request)
+                continue
+            # Don't propagate the cancellation of the request to the worker.
+            await asyncio.wait([self._start_request(request)])
+
+    def _start_request(self, request):
+        task = asyncio.ensure_future(self._handle_request(request))
+        self._running_requests[request.seq] = (request, task)
+        task.add_done_callback(lambda task: self._on_request_done(request, task))
+        return task
+
+    def _on_request_done(self, request, task):
+        # A task cancelled before it started never runs _handle_request, so the
+        # cancelled response is sent here.
+        if task.cancelled():
+            self._running_requests.pop(request.seq, None)
+            asyncio.ensure_future(self._send_cancelled_and_forget(request))
+
+    async def _send_cancelled_and_forget(self, request):
+        if not self.output.has_responded(request):
+            await self._send_cancelled(request)
+        self.output.forget_request(request)
+
+    async def _handle_request(self, request):
+        try:
+            await self.dispatcher.call(self, request)
+        except asyncio.CancelledError:
+            if not self.output.has_responded(request):
+                await self._send_cancelled(request)
+        except Exception as exc:
+            _logger.exception('Request failed: %s', request.command)
+            if not self.output.has_responded(request):
+                message = f'{type(exc).__name__}: {exc}'
+                await self.output.send_error_response(request, message, message, {})
+            else:
+                await self.output.send_event('output', {
+                    'category': 'stderr',
+                    'output': f'{request.command} failed: {type(exc).__name__}: {exc}\n',
+                })
+        finally:
+            self._running_requests.pop(request.seq, None)
+            self.output.forget_request(request)
 
     @dispatcher.register('initialize')
     async def on_initialize(self, request):
+        self._supports_progress = request.arguments.get('supportsProgressReporting', False)
         await self.output.send_response(request, self._capabilities())
         await self.output.send_event('initialized', {})
 
@@ -73,19 +176,52 @@ class Server:
 
     @dispatcher.register('pause')
     async def on_pause(self, request):
+        self._pause_requested = True
+        await self.output.send_response(request, {})
+
+    @dispatcher.register('cancel')
+    async def on_cancel(self, request):
+        args = request.arguments or {}
+        request_id = args.get('requestId')
+        if request_id is not None:
+            running_request = self._running_requests.get(request_id)
+            if running_request is not None:
+                running_request, task = running_request
+                if not self.output.has_responded(running_request):
+                    task.cancel()
+                elif running_request.command in _RESUMING_COMMANDS:
+                    # The client already got the response and waits for `stopped`.
+                    self._pause_requested = True
+            elif request_id in self._queued_requests:
+                self._cancelled_requests.add(request_id)
+        if args.get('progressId') is not None:
+            # The only cancellable progress is a running `continue`.
+            self._pause_requested = True
         await self.output.send_response(request, {})
 
     @dispatcher.register('continue')
     async def on_pause(self, request):
         await self.output.send_response(request, {})
 
-        self.runner.continue_until_breakpoint()
-        await self.output.send_event('stopped', {
-            'reason': 'breakpoint',
-            'threadId': 0,
-            'allThreadsStopped': True
-        })
-        await self._check_if_exited()
+        await self._continue()
+
+    @dispatcher.register('runToLocation')
+    async def on_run_to_location(self, request):
+        # Custom request to run until the source location, without adding a breakpoint.
+        args = request.arguments
+        target_pcs = self.runner.location_pcs(args['source'], args['line'])
+        if not target_pcs:
+            await self.output.send_error_response(request, 'no code at location', 'no code at location', {})
+            return
+        # The vm only runs forward, so a location it can't reach again would run to the end.
+        target_pcs = self.runner.reachable_pcs(target_pcs)
+        if not target_pcs:
+            await self.output.send_error_response(
+                request, 'location is not reachable', 'location is not reachable', {})
+            return
+        await self.output.send_response(request, {})
+
+        await self._continue(target_pcs)
 
     @dispatcher.register('next')
     async def on_pause(self, request):
@@ -108,6 +244,71 @@ class Server:
         self.runner.step_in()
         await self._send_stopped('step')
 
+    @dispatcher.register('traceQuery')
+    async def on_trace_query(self, request):
+        # Custom request to search the recorded trace. pcs are offsets from the program base.
+        trace = self.runner.trace()
+        if trace is None:
+            await self.output.send_error_response(request, 'trace is not recorded', 'trace is not recorded', {})
+            return
+
+        args = request.arguments or {}
+        query = args.get('query')
+        if query == 'steps':
+            pcs = args.get('pcs')
+            if not isinstance(pcs, list) or not all(isinstance(pc, int) for pc in pcs):
+                await self.output.send_error_response(request, 'invalid pcs argument', 'invalid pcs argument', {})
+                return
+            body = {'steps': trace.steps_at_pcs(pcs).tolist()}
+        elif query == 'functionRanges':
+            function = args.get('function')
+            function_pc = self.runner.function_pc_offset(function) if isinstance(function, str) else None
+            if function_pc is None:
+                await self.output.send_error_response(
+                    request, 'unknown function', 'unknown function {function}', {'function': str(function)})
+                return
+            body = {'ranges': [list(r) for r in trace.function_ranges(function_pc)]}
+        elif query == 'hottestPcs':
+            count = args.get('count', 10)
+            if not isinstance(count, int) or count < 0:
+                await self.output.send_error_response(request, 'invalid count argument', 'invalid count argument', {})
+                return
+            hottest_pcs = trace.hottest_pcs(count)
+            body = {'pcs': [{'pc': pc, 'hits': hits} for pc, hits in hottest_pcs]}
+        else:
+            await self.output.send_error_response(request, 'unknown query', 'unknown query {query}', {'query': query})
+            return
+
+        await self.output.send_response(request, body)
+
+    @dispatcher.register('hintProfile')
+    async def on_hint_profile(self, request):
+        # Custom request returning the calls and cumulative time of each hint.
+        hint_profile = self.runner.hint_profile()
+        if hint_profile is None:
+            await self.output.send_error_response(request, 'hints are not profiled', 'hints are not profiled', {})
+            return
+        await self.output.send_response(request, {'hints': hint_profile})
+
+    @dispatcher.register('memoryUsage')
+    async def on_memory_usage(self, request):
+        # Custom request returning the size of the runner and adapter data.
+        await self.output.send_response(request, self.runner.memory_usage())
+
+    @dispatcher.register('gotoStep')
+    async def on_goto_step(self, request):
+        # Custom request to move the session to a step, e.g. one found with traceQuery.
+        step = (request.arguments or {}).get('step')
+        if not isinstance(step, int) or step < 0:
+            await self.output.send_error_response(request, 'invalid step argument', 'invalid step argument', {})
+            return
+        await self.output.send_response(request, {})
+
+        # Going back replays the program from the start, so it runs in chunks like `continue`.
+        paused = await self._run_in_chunks(
+            'Going to step', lambda: self.runner.goto_step(step, max_steps=_CONTINUE_CHUNK_STEPS))
+        await self._send_stopped('pause' if paused else 'goto')
+
     @dispatcher.register('setBreakpoints')
     async def on_set_breakpoints(self, request):
         source = request.arguments['source']
@@ -128,6 +329,19 @@ class Server:
 
         await self.output.send_response(request, {'breakpoints': breakpoints})
 
+    @dispatcher.register('setExceptionBreakpoints')
+    async def on_set_exception_breakpoints(self, request):
+        self.runner.set_exception_filters(request.arguments.get('filters', []))
+        await self.output.send_response(request, {})
+
+    @dispatcher.register('exceptionInfo')
+    async def on_exception_info(self, request):
+        exception_info = self.runner.exception_info()
+        if exception_info is None:
+            await self.output.send_error_response(request, 'no exception', 'no exception', {})
+            return
+        await self.output.send_response(request, exception_info)
+
     @dispatcher.register('threads')
     async def on_threads(self, request):
         threads = [{'id': 0, 'name': 'main'}]
@@ -147,8 +361,18 @@ class Server:
 
     @dispatcher.register('variables')
     async def on_variables(self, request):
-        variables_ref = request.arguments['variablesReference']
-        variables = self.runner.variables(variables_ref)
+        args = request.arguments
+        variables_ref = args['variablesReference']
+        progress_id = None
+        try:
+            if not self.runner.has_variables(variables_ref):
+                progress_id = await self._start_progress('Loading variables', cancellable=False)
+                # Give the client a chance to cancel the request before the expensive part.
+                await asyncio.sleep(0)
+            variables = self.runner.variables(
+                variables_ref, args.get('filter'), args.get('start'), args.get('count'))
+        finally:
+            await self._end_progress(progress_id)
         await self.output.send_response(request, {'variables': variables})
 
     @dispatcher.fallback()
@@ -163,22 +387,104 @@ class Server:
             'supportsStepBack': False,
             'supportsRestartRequest': False,
             'supportsReadMemoryRequest': True,
+            'supportsCancelRequest': True,
+            'supportsExceptionInfoRequest': True,
+            'exceptionBreakpointFilters': EXCEPTION_FILTERS,
         }
 
+    async def _send_cancelled(self, request):
+        await self.output.send_error_response(request, 'cancelled', 'cancelled', {})
+
+    async def _start_progress(self, title, cancellable):
+        if not self._supports_progress:
+            return None
+        self._progress_id += 1
+        progress_id = str(self._progress_id)
+        await self.output.send_event('progressStart', {
+            'progressId': progress_id,
+            'title': title,
+            'cancellable': cancellable,
+        })
+        return progress_id
+
+    async def _update_progress(self, progress_id, message):
+        if progress_id is None:
+            return
+        await self.output.send_event('progressUpdate', {
+            'progressId': progress_id,
+            'message': message,
+        })
+
+    async def _end_progress(self, progress_id):
+        if progress_id is None:
+            return
+        await self.output.send_event('progressEnd', {
+            'progressId': progress_id,
+        })
+
+    async def _continue(self, target_pcs=None):
+        paused = await self._run_in_chunks(
+            'Running program',
+            lambda: self.runner.continue_until_breakpoint(
+                max_steps=_CONTINUE_CHUNK_STEPS, target_pcs=target_pcs))
+
+        reason = 'breakpoint'
+        if paused:
+            reason = 'pause'
+        elif target_pcs is not None and self.runner.stopped_at_target():
+            reason = 'goto'
+        await self._send_stopped(reason)
+
+    async def _run_in_chunks(self, title, run_chunk):
+        # Call run_chunk until it returns True, flushing the program output and
+        # letting other requests in between chunks of _CONTINUE_CHUNK_STEPS steps.
+        # Returns True if the program was paused.
+        self._pause_requested = False
+        progress_id = await self._start_progress(title, cancellable=True)
+        steps = 0
+        try:
+            while not run_chunk():
+                steps += _CONTINUE_CHUNK_STEPS
+                await self._send_program_output()
+                await self._update_progress(progress_id, f'{steps} steps')
+                await asyncio.sleep(0)
+                if self._pause_requested:
+                    self.runner.pause()
+                    return True
+        finally:
+            await self._end_progress(progress_id)
+        return False
+
     async def _send_stopped(self, reason):
-        await self.output.send_event('stopped', {
+        await self._send_program_output()
+        exception_info = self.runner.exception_info()
+        if exception_info is not None and not self.runner.breaks_on_exception():
+            await self._terminate_on_exception(exception_info)
+            return
+
+        body = {
             'reason': reason,
             'threadId': 0,
             'allThreadsStopped': True
-        })
+        }
+        if exception_info is not None:
+            body['reason'] = 'exception'
+            body['description'] = 'Paused on exception'
+            body['text'] = exception_info['description']
+        elif self.runner.stopped_on_step_budget():
+            body['reason'] = 'step budget'
+            body['description'] = 'Paused: the maximum number of steps was executed'
+        await self.output.send_event('stopped', body)
         await self._check_if_exited()
 
     async def _check_if_exited(self):
         if self.runner.has_exited():
-            for output_val in self.runner.program_output():
+            await self._send_program_output()
+            hint_profile = self.runner.hint_profile()
+            if hint_profile is not None:
                 await self.output.send_event('output', {
                     'category': 'console',
-                    'output': f'{output_val}\n'
+                    'output': format_report(hint_profile) + '\n',
                 })
             await self.output.send_event('exited', {
                 'exitCode': 0,
@@ -187,6 +493,25 @@ class Server:
                 'restart': False,
             })
 
+    async def _terminate_on_exception(self, exception_info):
+        await self.output.send_event('output', {
+            'category': 'stderr',
+            'output': exception_info['details']['message'] + '\n',
+        })
+        await self.output.send_event('exited', {
+            'exitCode': 1,
+        })
+        await self.output.send_event('terminated', {
+            'restart': False,
+        })
+
+    async def _send_program_output(self):
+        for output_val in self.runner.program_output():
+            await self.output.send_event('output', {
+                'category': 'console',
+                'output': f'{output_val}\n'
+            })
+
 
 async def dap_server(runner, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     server = Server(runner, reader, writer)
@@ -0,0 +1,157 @@
+"""
+Columnar execution trace, stored in memory-mapped files.
+
+The pc, ap and fp offsets of each step are stored in separate fixed-width
+integer columns so that they can be scanned with numpy.
+"""
+from pathlib import Path
+
+import numpy as np
+
+_DTYPE = np.int64
+_COLUMNS = ('pc', 'ap', 'fp')
+# Number of entries kept in memory before being written to the column files.
+_BUFFER_SIZE = 4096
+# Initial number of entries allocated for each column file.
+_INITIAL_CAPACITY = 1 << 16
+
+
+class TraceRecorder:
+    """
+    Records the trace of a run, step by step, to the column files in `directory`.
+    """
+
+    def __init__(self, directory):
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._length = 0
+        self._capacity = 0
+        self._columns = dict()
+        self._buffer = []
+        self._closed = False
+        self._grow(_INITIAL_CAPACITY)
+
+    def __len__(self):
+        return self._length + len(self._buffer)
+
+    def append(self, pc, ap, fp):
+        self._buffer.append((pc, ap, fp))
+        if len(self._buffer) >= _BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        new_length = self._length + len(self._buffer)
+        if new_length > self._capacity:
+            self._grow(max(new_length, 2 * self._capacity))
+        values = np.array(self._buffer, dtype=_DTYPE)
+        for i, name in enumerate(_COLUMNS):
+            self._columns[name][self._length:new_length] = values[:, i]
+        self._length = new_length
+        self._buffer = []
+
+    def close(self):
+        # Truncate the files to the trace length so that they can be opened with `Trace.open`.
+        if self._closed:
+            return
+        self.flush()
+        for name in _COLUMNS:
+            self._columns[name].flush()
+        self._columns = dict()
+        for name in _COLUMNS:
+            _resize_column_file(self._column_path(name), self._length)
+        self._closed = True
+
+    def trace(self):
+        """Return a query view over the steps recorded so far."""
+        if self._closed:
+            return Trace.open(self._directory)
+        self.flush()
+        return Trace(*(self._columns[name][:self._length] for name in _COLUMNS))
+
+    def _grow(self, capacity):
+        for column in self._columns.values():
+            column.flush()
+        self._columns = dict()
+        for name in _COLUMNS:
+            path = self._column_path(name)
+            _resize_column_file(path, capacity)
+            self._columns[name] = np.memmap(path, dtype=_DTYPE, mode='r+', shape=(capacity,))
+        self._capacity = capacity
+
+    def _column_path(self, name):
+        return self._directory / f'{name}.bin'
+
+
+class Trace:
+    """
+    Query API over the pc, ap and fp columns of a trace.
+
+    pc values are offsets from the program base, ap and fp values are offsets in
+    the execution segment.
+    """
+
+    def __init__(self, pc, ap, fp):
+        self.pc = pc
+        self.ap = ap
+        self.fp = fp
+
+    @staticmethod
+    def open(directory):
+        directory = Path(directory)
+        return Trace(*(_open_column(directory / f'{name}.bin') for name in _COLUMNS))
+
+    def __len__(self):
+        return len(self.pc)
+
+    def steps_at_pcs(self, pcs):
+        """Return the steps where the pc is one of `pcs`."""
+        return np.flatnonzero(np.isin(self.pc, np.fromiter(pcs, dtype=_DTYPE)))
+
+    def function_ranges(self, function_pc):
+        """
+        Return the (start, end) step ranges of each call to the function starting at
+        `function_pc`, including the steps of the functions it calls.
+        """
+        starts = np.flatnonzero(self.pc == function_pc)
+        if len(starts) == 0:
+            return []
+        length = len(self)
+
+        # fp only changes on call (up) and ret (down), so the call depth of each
+        # step is the running count of fp changes.
+        depth = np.zeros(length, dtype=_DTYPE)
+        np.cumsum(np.sign(np.diff(self.fp)), out=depth[1:])
+        # The steps right after each ret, sorted by (depth, step).
+        returns = np.flatnonzero(np.diff(depth) < 0) + 1
+        min_depth = depth.min()
+        stride = length + 1
+        return_keys = np.sort((depth[returns] - min_depth) * stride + returns)
+
+        # A call ends at the first step after its start that returns to the depth of the caller.
+        caller_depths = depth[starts] - 1 - min_depth
+        indices = np.searchsorted(return_keys, caller_depths * stride + starts, side='right')
+        found = indices < len(return_keys)
+        found[found] = return_keys[indices[found]] // stride == caller_depths[found]
+        ends = np.full(len(starts), length, dtype=_DTYPE)
+        ends[found] = return_keys[indices[found]] % stride
+        return [(int(start), int(end)) for start, end in zip(starts, ends)]
+
+    def hottest_pcs(self, count):
+        """Return the `count` most executed pcs, with the number of times they were executed."""
+        pcs, hits = np.unique(self.pc, return_counts=True)
+        order = np.argsort(-hits, kind='stable')[:count]
+        return [(int(pcs[i]), int(hits[i])) for i in order]
+
+
+def _open_column(path):
+    # numpy can't memory-map empty files.
+    if path.stat().st_size == 0:
+        return np.zeros(0, dtype=_DTYPE)
+    return np.memmap(path, dtype=_DTYPE, mode='r')
+
+
+def _resize_column_file(path, length):
+    with open(path, 'ab') as column_file:
+        column_file.truncate(length * np.dtype(_DTYPE).itemsize)
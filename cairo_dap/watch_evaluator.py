@@ -15,8 +15,10 @@ from starkware.cairo.lang.compiler.type_system_visitor import simplify_type_syst
 
 
 class WatchEvaluator(ExpressionEvaluator):
-    def __init__(self, runner, program, run_context, program_base):
-        super().__init__(program.prime, ap=run_context.ap, fp=run_context.fp, memory=run_context.memory)
+    def __init__(self, runner, program, run_context, program_base, memory=None):
+        if memory is None:
+            memory = run_context.memory
+        super().__init__(program.prime, ap=run_context.ap, fp=run_context.fp, memory=memory)
 
         self.runner = runner
         self.program = program